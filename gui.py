@@ -1,7 +1,11 @@
+import functools
+import logging
 import sys
 from PyQt5.QtWidgets import QApplication, QMainWindow
-from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QGuiApplication
+from PyQt5.QtCore import QEvent, Qt
 
+logger = logging.getLogger("nanokvm.gui")
 
 # ——————————————————————————————————————————————
 # HID usage map for common keys
@@ -38,20 +42,74 @@ qt_to_hid_int_map = {
     Qt.Key_F5: 0x3E, Qt.Key_F6: 0x3F, Qt.Key_F7: 0x40, Qt.Key_F8: 0x41,
     Qt.Key_F9: 0x42, Qt.Key_F10: 0x43, Qt.Key_F11: 0x44, Qt.Key_F12: 0x45,
 
-    Qt.Key_NumLock: 0x53, Qt.Key_Slash: 0x54,
-    Qt.Key_Asterisk: 0x55, Qt.Key_Minus: 0x56,
+    Qt.Key_NumLock: 0x53, Qt.Key_Asterisk: 0x55,
 }
 
+# Keys on the numeric keypad arrive with the same Qt key codes as their
+# main keyboard counterparts, plus Qt.KeypadModifier, so they are mapped
+# separately. Arrow keys are left out as macOS flags those as keypad keys.
+qt_keypad_to_hid_int_map = {
+    Qt.Key_Slash: 0x54, Qt.Key_Asterisk: 0x55, Qt.Key_Minus: 0x56,
+    Qt.Key_Plus: 0x57, Qt.Key_Enter: 0x58,
 
-# Build reverse lookup of all Qt.Key_* attributes
-qt_key_name_map = {
-    getattr(Qt, name): name
-    for name in dir(Qt)
-    if name.startswith("Key_")
+    Qt.Key_1: 0x59, Qt.Key_2: 0x5A, Qt.Key_3: 0x5B, Qt.Key_4: 0x5C,
+    Qt.Key_5: 0x5D, Qt.Key_6: 0x5E, Qt.Key_7: 0x5F, Qt.Key_8: 0x60,
+    Qt.Key_9: 0x61, Qt.Key_0: 0x62, Qt.Key_Period: 0x63,
 }
 
+
+def qt_key_index(key_code):
+    """Fold a Qt key code into an index of the flat HID lookup table.
+
+    Qt key codes are either Latin-1 characters (< 0x100) or special keys in
+    the 0x01000000 page. Both fit in a 512 entry table. Anything else maps
+    to index 0, which is never populated.
+    """
+    if key_code < 0x100:
+        return key_code
+    if key_code & ~0xFF == 0x01000000:
+        return 0x100 | (key_code & 0xFF)
+    return 0
+
+
+def build_hid_lut(key_map):
+    """Flatten a Qt key -> HID usage map into a table indexed by qt_key_index().
+
+    A value of 0 in the table means the key is not handled.
+    """
+    lut = bytearray(0x200)
+    for key, hid in key_map.items():
+        lut[qt_key_index(key)] = hid
+    return bytes(lut)
+
+
+# Flat tables so the key event path is a plain index rather than a dict
+# lookup. Each Qt key resolves to exactly one usage per table.
+qt_to_hid_lut = build_hid_lut(qt_to_hid_int_map)
+qt_keypad_to_hid_lut = build_hid_lut(qt_keypad_to_hid_int_map)
+
+# HID usage -> modifier byte bit, for the modifier keys 0xE0 to 0xE7.
+hid_modifier_bits = bytes(
+    1 << (hid - 0xE0) if 0xE0 <= hid <= 0xE7 else 0
+    for hid in range(0x100)
+)
+
+
+# Bound on the number of resolved key events KeyCaptureWindow keeps.
+HID_CACHE_SIZE = 512
+
+
+@functools.lru_cache(maxsize=None)
+def qt_key_name_map():
+    """Build reverse lookup of all Qt.Key_* attributes on first use."""
+    return {
+        getattr(Qt, name): name
+        for name in dir(Qt)
+        if name.startswith("Key_")
+    }
+
 def qt_key_code_to_name(key_code):
-    return qt_key_name_map.get(key_code, f"UnknownKey({key_code})")
+    return qt_key_name_map().get(key_code, f"UnknownKey({key_code})")
 
 class KeyCaptureWindow(QMainWindow):
     def __init__(self, device):
@@ -63,24 +121,73 @@ class KeyCaptureWindow(QMainWindow):
         self.setFocusPolicy(Qt.StrongFocus)
 
         # We can send up to 6 keys according to the HID spec.
-        self.pressed_keys = set()
+        # Held keys, by physical key, mapped to the HID usage they were
+        # resolved to when pressed.
+        self.pressed_keys = {}
+
+        # (native virtual key, modifiers) -> HID usage. With the keyboard
+        # layout fixed these determine the Qt key and keypad flag the
+        # resolution depends on, so the cache is dropped whenever the layout
+        # or input method locale changes.
+        self.hid_cache = {}
+        QGuiApplication.inputMethod().localeChanged.connect(self.hid_cache.clear)
+
+    @staticmethod
+    def physicalKey(event):
+        scan_code = event.nativeScanCode()
+        if scan_code:
+            return scan_code
+        # Without a scan code fall back to the Qt key code, negated to keep
+        # it apart from scan codes, which share the same small range.
+        return -event.key()
+
+    def resolveHidCode(self, event):
+        """Return the HID usage for a key event, or 0 if it is unhandled."""
+        native_key = event.nativeVirtualKey()
+        if not native_key:
+            # Not reported on this platform, so there is nothing to key on.
+            return self.lookupHidCode(event)
+
+        cache_key = (native_key, int(event.modifiers()))
+        hid_code = self.hid_cache.get(cache_key)
+        if hid_code is None:
+            if len(self.hid_cache) >= HID_CACHE_SIZE:
+                self.hid_cache.clear()
+            hid_code = self.lookupHidCode(event)
+            self.hid_cache[cache_key] = hid_code
+        return hid_code
+
+    @staticmethod
+    def lookupHidCode(event):
+        """Resolve a key event to its HID usage through the lookup tables."""
+        key = event.key()
+        index = qt_key_index(key)
+        hid_code = 0
+        if event.modifiers() & Qt.KeypadModifier:
+            hid_code = qt_keypad_to_hid_lut[index]
+        if not hid_code:
+            hid_code = qt_to_hid_lut[index]
+        if not hid_code:
+            if logger.isEnabledFor(logging.DEBUG):
+                name = qt_key_code_to_name(key)
+                logger.debug("Unhandled key event : %s %s", key, name)
+        return hid_code
+
+    def event(self, event):
+        if event.type() == QEvent.KeyboardLayoutChange:
+            self.hid_cache.clear()
+        return super().event(event)
 
     def emitHidReport(self):
         modifier_byte = 0
         keycodes = []
 
-        for key in self.pressed_keys:
-            hid_code = qt_to_hid_int_map.get(key)
-            if hid_code is None:
-                name = qt_key_code_to_name(key)
-                print(f"Unhandled key event : {key} {name}")
-                continue
-            if 0xE0 <= hid_code <= 0xE7:
-                # Modifier range
-                modifier_byte |= 1 << (hid_code - 0xE0)
-            else:
-                if len(keycodes) < 6:
-                    keycodes.append(hid_code)
+        for hid_code in self.pressed_keys.values():
+            modifier_bit = hid_modifier_bits[hid_code]
+            if modifier_bit:
+                modifier_byte |= modifier_bit
+            elif len(keycodes) < 6:
+                keycodes.append(hid_code)
 
         # Pad with 0x00s to fill 6 slots
         while len(keycodes) < 6:
@@ -94,8 +201,11 @@ class KeyCaptureWindow(QMainWindow):
         if event.isAutoRepeat():
             return
 
-        qt_key = event.key()
-        self.pressed_keys.add(qt_key)
+        hid_code = self.resolveHidCode(event)
+        if not hid_code:
+            return
+
+        self.pressed_keys[self.physicalKey(event)] = hid_code
         self.emitHidReport()
 
 
@@ -103,8 +213,10 @@ class KeyCaptureWindow(QMainWindow):
         if event.isAutoRepeat():
             return
 
-        qt_key = event.key()
-        self.pressed_keys.discard(qt_key)
+        # Release what was pressed on this physical key, even if modifiers
+        # now give it a different Qt key code (e.g. '1' released as '!').
+        if self.pressed_keys.pop(self.physicalKey(event), None) is None:
+            return
         self.emitHidReport()
 
 
@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
+import collections
 import logging
 import serial
 import threading
 
 from enum import IntEnum
-from typing import List
+from typing import List, Tuple
 
 from gui import Gui
 
@@ -16,21 +17,23 @@ See:
  - https://github.com/sipeed/NanoKVM-USB/blob/main/desktop/src/main/device/proto.ts
 """
 
+logger = logging.getLogger("nanokvm")
 
-def get_bit(value: int, bit: int) -> int:
-    """Return the bit (0 or 1) at position `bit` in `value`."""
-    return (value >> bit) & 1
 
 # ----------------------------------------------------------------------
 # helpers for byte conversions
 # ----------------------------------------------------------------------
-def int_to_byte(value: int) -> int:
-    """Clamp an integer into a single byte."""
-    return value & 0xFF
+def checksum(buf) -> int:
+    """Return the 8-bit additive checksum of a bytes-like `buf`."""
+    return sum(memoryview(buf)) & 0xFF
 
-def int_to_little_endian_list(value: int, length: int = 2) -> List[int]:
-    """Return a list of `length` bytes, little‐endian, representing `value`."""
-    return [(value >> (8 * i)) & 0xFF for i in range(length)]
+def int_to_little_endian_bytes(value: int, length: int = 2) -> bytes:
+    """Return `length` bytes, little‐endian, representing `value`.
+
+    Like the per-byte masking this replaces, out of range values wrap
+    rather than raise.
+    """
+    return (value & ((1 << (8 * length)) - 1)).to_bytes(length, "little")
 
 class CmdEvent(IntEnum):
     GET_INFO = 0x01
@@ -52,16 +55,24 @@ class CmdEvent(IntEnum):
 class CmdPacket:
     HEAD1 = 0x57
     HEAD2 = 0xAB
+    HEAD = bytes((HEAD1, HEAD2))
+
+    # Replies carry the request CMD with bit 7 set, and bit 6 too on error.
+    REPLY = 0x80
+    REPLY_ERROR = 0xC0
+
+    __slots__ = ("ADDR", "CMD", "LEN", "DATA", "SUM", "buf")
 
-    def __init__(self, addr: int = 0x00, cmd: int = 0x00, data: List[int] = None):
+    def __init__(self, addr: int = 0x00, cmd: int = 0x00, data: bytes = None):
         self.ADDR = 0x00
         self.CMD = 0x00
         self.LEN = 0x00
-        self.DATA: List[int] = []
+        self.DATA = b""
         self.SUM = 0x00
+        self.buf = bytearray()
 
         if data is None:
-            data = []
+            data = b""
 
         # if negative addr or cmd, treat `data` as a raw packet to decode
         if addr < 0 or cmd < 0:
@@ -69,69 +80,100 @@ class CmdPacket:
         else:
             self._save(addr, cmd, data)
 
-    def encode(self) -> List[int]:
-        """Build the byte packet."""
-        return [self.HEAD1, self.HEAD2, self.ADDR, self.CMD, self.LEN, *self.DATA, self.SUM]
+    def encode(self) -> bytearray:
+        """Return the serialised byte packet."""
+        return self.buf
 
-    def decode(self, raw: List[int]) -> int:
+    def decode(self, raw: bytes) -> int:
         """Parse a raw byte stream into fields. Returns 0 on success, -1 on failure."""
-        hi = self._find_head(raw)
-        if hi < 0:
-            print("cannot find HEAD")
-            return -1
-
-        if len(raw) - hi < 6:
-            print("len error1")
-            return -1
-
-        addr = raw[hi + 2]
-        cmd = raw[hi + 3]
-        data_len = raw[hi + 4]
-
-        if len(raw) < hi + 5 + data_len + 1:
-            print("len error2")
-            return -1
-
-        try:
-            summ = raw[hi + 5 + data_len]
-        except IndexError:
-            print("len error3")
-            return -1
+        if not isinstance(raw, (bytes, bytearray)):
+            raw = bytes(raw)
 
-        s = sum(raw[hi : hi + 5 + data_len])
-        if (s & 0xFF) != summ:
-            # checksum mismatch
+        start, end = self.find_frame(raw)
+        if start < 0:
+            logger.debug("no valid packet found")
             return -1
 
-        # all good—assign to self
-        self.ADDR = addr
-        self.CMD = cmd
-        self.LEN = data_len
-        self.DATA = raw[hi + 5 : hi + 5 + data_len]
-        self.SUM = summ
+        self._load(raw, start, end)
         return 0
 
-    def _find_head(self, lst: List[int]) -> int:
-        """Find the index of the [HEAD1, HEAD2] sequence in `lst`."""
-        seq = [self.HEAD1, self.HEAD2]
-        for i in range(len(lst) - 1):
-            if lst[i] == seq[0] and lst[i + 1] == seq[1]:
-                return i
-        return -1
+    @classmethod
+    def find_frame(cls, raw: bytes) -> Tuple[int, int]:
+        """Locate the first complete frame with a valid checksum in `raw`.
+
+        Returns (start, end) such that raw[start:end] is the frame. If there
+        is none, start is -1 and end is the offset of the first byte that
+        could still begin a frame once more data arrives, so everything
+        before it can be discarded.
+        """
+        size = len(raw)
+        # Keep a trailing HEAD1, it may be the start of the next HEAD.
+        keep = size - 1 if raw.endswith(cls.HEAD[:1]) else size
+
+        # The HEAD sequence can also turn up in line noise or inside a
+        # payload, and a false one may claim more data than will ever
+        # arrive, so check every candidate rather than just the first.
+        hi = raw.find(cls.HEAD)
+        while hi >= 0:
+            if size - hi < 6:
+                # No later candidate can be complete either.
+                logger.debug("len error1")
+                return -1, min(keep, hi)
+
+            end = hi + 5 + raw[hi + 4]
+            if end >= size:
+                # Incomplete, but may still turn out to be valid.
+                logger.debug("len error2")
+                keep = min(keep, hi)
+            elif checksum(memoryview(raw)[hi:end]) == raw[end]:
+                return hi, end + 1
+            else:
+                logger.debug("checksum error")
+
+            hi = raw.find(cls.HEAD, hi + 1)
+
+        return -1, keep
+
+    @classmethod
+    def from_frame(cls, raw: bytes, start: int, end: int) -> "CmdPacket":
+        """Build a packet from the already validated frame raw[start:end]."""
+        pkt = cls.__new__(cls)
+        pkt._load(raw, start, end)
+        return pkt
+
+    def _load(self, raw: bytes, start: int, end: int) -> None:
+        """Fill in the fields from the already validated frame raw[start:end]."""
+        self.ADDR = raw[start + 2]
+        self.CMD = raw[start + 3]
+        self.LEN = raw[start + 4]
+        self.DATA = bytes(raw[start + 5 : end - 1])
+        self.SUM = raw[end - 1]
+        self.buf = bytearray(raw[start:end])
+
+    def _save(self, addr: int, cmd: int, data: bytes) -> None:
+        """Prepare fields, serialise the packet and compute its checksum."""
+        data_len = len(data)
+        buf = bytearray(5 + data_len + 1)
+        buf[0] = self.HEAD1
+        buf[1] = self.HEAD2
+        buf[2] = addr
+        buf[3] = cmd
+        buf[4] = data_len
+        buf[5 : 5 + data_len] = data
+        buf[-1] = checksum(memoryview(buf)[:-1])
 
-    def _save(self, addr: int, cmd: int, data: List[int]) -> None:
-        """Prepare fields and compute checksum."""
         self.ADDR = addr
         self.CMD = cmd
-        self.DATA = data.copy()
-        self.LEN = len(data)
-
-        total = self.HEAD1 + self.HEAD2 + self.ADDR + self.CMD + self.LEN + sum(self.DATA)
-        self.SUM = total & 0xFF
+        self.LEN = data_len
+        self.DATA = bytes(data)
+        self.SUM = buf[-1]
+        self.buf = buf
 
 
 
 class InfoPacket:
+    __slots__ = ("CHIP_VERSION", "IS_CONNECTED", "NUM_LOCK", "CAPS_LOCK", "SCROLL_LOCK")
+
     def __init__(self, data: List[int]):
         if data[0] < 0x30:
             raise ValueError("version error")
@@ -141,9 +183,10 @@ class InfoPacket:
         self.CHIP_VERSION = f"V{version:.1f}"
 
         self.IS_CONNECTED = bool(data[1])
-        self.NUM_LOCK = get_bit(data[2], 0) == 1
-        self.CAPS_LOCK = get_bit(data[2], 1) == 1
-        self.SCROLL_LOCK = get_bit(data[2], 2) == 1
+        leds = data[2]
+        self.NUM_LOCK = bool(leds & 0x01)
+        self.CAPS_LOCK = bool(leds & 0x02)
+        self.SCROLL_LOCK = bool(leds & 0x04)
 
     def __str__(self) -> str:
         return (
@@ -165,45 +208,226 @@ class NanoKVM(object):
         self.serial_port = serial_instance
         self.addr = addr
         self._write_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._report_lock = threading.Lock()
+
+        # Outgoing packets are queued and written out in batches by a
+        # background thread, so bursts of input cost one write each. A write
+        # error in that thread is kept and raised by the next send or flush.
+        self._tx_queue = collections.deque()
+        self._tx_event = threading.Event()
+        self._tx_stop = threading.Event()
+        self._tx_error = None
+        self._tx_thread = threading.Thread(
+            target=self._tx_worker, name="nanokvm-tx", daemon=True)
+        self._tx_thread.start()
+
+        # Received bytes not yet consumed by read_packet().
+        self._rx_buf = bytearray()
+
+        # Fixed point (32.32) scale factors for absolute mouse coordinates,
+        # recomputed only when the display size changes, under _report_lock.
+        self._abs_w = self._abs_h = 0
+        self._abs_kx = self._abs_ky = 0
+
+        # Last keyboard report sent, so repeats of an unchanged report can be
+        # dropped. Cleared whenever the target connection state changes.
+        self._last_report = None
+        self._connected = None
+
+        # Every key release ends in an empty report, so encode it only once.
+        self._kb_release = bytes(
+            CmdPacket(addr, CmdEvent.SEND_KB_GENERAL_DATA, bytes(8)).encode())
+
+        # Input reports have a fixed size, so each has a preallocated packet
+        # whose payload and checksum are updated in place under _report_lock.
+        self._kb_buf = CmdPacket(addr, CmdEvent.SEND_KB_GENERAL_DATA, bytes(8)).encode()
+        self._rel_buf = CmdPacket(addr, CmdEvent.SEND_MS_REL_DATA, b"\x01" + bytes(4)).encode()
+        self._abs_buf = CmdPacket(addr, CmdEvent.SEND_MS_ABS_DATA, b"\x02" + bytes(6)).encode()
+
+    def _tx_worker(self) -> None:
+        while True:
+            self._tx_event.wait()
+            self._tx_event.clear()
+            if self._tx_stop.is_set():
+                return
+
+            try:
+                self._write_queued()
+            except Exception as e:
+                logger.error("Failed to write to the serial port: %s", e)
+                self._tx_error = e
+                # The target may not have seen the last report, so don't let
+                # it suppress the next one.
+                with self._report_lock:
+                    self._last_report = None
+
+    def _raise_tx_error(self) -> None:
+        """Raise, once, any error the transmit thread hit since the last call."""
+        error = self._tx_error
+        if error is not None:
+            self._tx_error = None
+            raise error
+
+    def _queue_packet(self, pkt) -> None:
+        """Queue a copy of `pkt` for the transmit thread."""
+        if self._tx_stop.is_set():
+            raise ValueError("NanoKVM is closed")
+        self._raise_tx_error()
+        self._tx_queue.append(bytes(pkt))
+        self._tx_event.set()
+
+    def _write_queued(self) -> None:
+        with self._write_lock:
+            queue = self._tx_queue
+            if not queue:
+                return
+            data = b"".join([queue.popleft() for _ in range(len(queue))])
+            self.serial_port.write(data)
+
+    def flush(self) -> None:
+        """Write out any queued packets."""
+        self._raise_tx_error()
+        self._write_queued()
+
+    def close(self) -> None:
+        """Stop the transmit thread, writing out anything still queued."""
+        self._tx_stop.set()
+        self._tx_event.set()
+        self._tx_thread.join()
+
+        # An earlier write error has already been logged, and raising it
+        # here would only get in the way of shutting down.
+        error, self._tx_error = self._tx_error, None
+        if error is not None:
+            logger.debug("dropping earlier transmit error: %s", error)
+        self._write_queued()
+
+    def read_packet(self) -> CmdPacket:
+        """Read the next valid packet from the serial port.
+
+        Received bytes are kept in a persistent buffer, so line noise ahead
+        of a packet is discarded and anything after it is kept for the next
+        call. Raises IOError if the port times out first.
+        """
+        buf = self._rx_buf
+        while True:
+            start, end = CmdPacket.find_frame(buf)
+            if start >= 0:
+                pkt = CmdPacket.from_frame(buf, start, end)
+                del buf[:end]
+                return pkt
+
+            del buf[:end]
+
+            chunk = self.serial_port.read(self.serial_port.in_waiting or 1)
+            if not chunk:
+                raise IOError("timed out waiting for a packet")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("RX: %s", chunk.hex(" "))
+            buf += chunk
 
     def get_info(self) -> "InfoPacket":
         pkt = CmdPacket(self.addr, CmdEvent.GET_INFO).encode()
-        self.serial_port.write(bytes(pkt))
-        raw = self.serial_port.read(14)
-        print("RAW INFO RESPONSE:", [hex(b) for b in raw])
-        ret = CmdPacket(-1, -1, list(raw)).decode(list(raw))
-        print("decode() returned", ret)
-
-        rsp = CmdPacket(-1, -1, list(raw))
-        return InfoPacket(rsp.DATA)
-
-    def send_hid_report(self, data) -> None:
-        #print("HID REPORT DATA: ", [hex(b) for b in data])
-        pkt = CmdPacket(self.addr, CmdEvent.SEND_KB_GENERAL_DATA, data[:8]).encode()
-        self.serial_port.write(bytes(pkt))
+        self.flush()
+        # Only hold _write_lock for the request itself, so queued reports
+        # are not held up while waiting on the reply.
+        with self._read_lock:
+            with self._write_lock:
+                self.serial_port.write(pkt)
+
+            # Acks for earlier reports may still be waiting ahead of the reply.
+            while True:
+                rsp = self.read_packet()
+                if rsp.CMD == CmdEvent.GET_INFO | CmdPacket.REPLY:
+                    break
+                if rsp.CMD == CmdEvent.GET_INFO | CmdPacket.REPLY_ERROR:
+                    raise IOError(f"GET_INFO failed: {rsp.DATA.hex()}")
+                logger.debug("skipping reply to command %#x", rsp.CMD)
+
+        if len(rsp.DATA) < 3:
+            raise IOError("short GET_INFO response")
+
+        info = InfoPacket(rsp.DATA)
+
+        with self._report_lock:
+            if info.IS_CONNECTED != self._connected:
+                # The target can not be relied upon to hold our last report
+                # across a (re)connection, so make sure the next one is sent.
+                self._connected = info.IS_CONNECTED
+                self._last_report = None
+
+        return info
+
+    def send_hid_report(self, data, force: bool = False) -> None:
+        """Send an 8 byte keyboard report, unless it repeats the last one sent.
+
+        Pass `force` to send the report regardless.
+        """
+        report = data[:8]
+        if len(report) != 8:
+            raise ValueError("keyboard report must be 8 bytes")
+
+        with self._report_lock:
+            self._raise_tx_error()
+
+            if any(report):
+                pkt = self._kb_buf
+                pkt[5:13] = report
+                pkt[-1] = checksum(memoryview(pkt)[:-1])
+            else:
+                pkt = self._kb_release
+
+            if not force and pkt == self._last_report:
+                return
+            pkt = bytes(pkt)
+            self._queue_packet(pkt)
+            self._last_report = pkt
 
     def send_keyboard_data(self, modifier: int, key: int) -> None:
-        data = [modifier, 0x00, 0x00, 0x00, key, 0x00, 0x00, 0x00]
+        data = bytes((modifier, 0x00, 0x00, 0x00, key, 0x00, 0x00, 0x00))
         self.send_hid_report(data)
 
     def send_mouse_relative_data(self, key: int, x: int, y: int, scroll: int) -> None:
-        x_b = int_to_byte(x)
-        y_b = int_to_byte(y)
-        data = [0x01, key, x_b, y_b, scroll]
-        pkt = CmdPacket(self.addr, CmdEvent.SEND_MS_REL_DATA, data).encode()
-        self.serial_port.write(bytes(pkt))
+        with self._report_lock:
+            pkt = self._rel_buf
+            pkt[6] = key
+            pkt[7] = x & 0xFF
+            pkt[8] = y & 0xFF
+            pkt[9] = scroll
+            pkt[-1] = checksum(memoryview(pkt)[:-1])
+            self._queue_packet(pkt)
+
+    @staticmethod
+    def _abs_scale(size: int) -> int:
+        """Return the 32.32 fixed point factor mapping [0, size) onto [0, 4096).
+
+        Rounding the reciprocal up makes (v * factor) >> 32 equal to
+        (v * 4096) // size for any 0 <= v with v * size < 2**32.
+        """
+        if size == 0:
+            return 0
+        return ((4096 << 32) + size - 1) // size
 
     def send_mouse_absolute_data(
         self, key: int, width: int, height: int, x: int, y: int, scroll: int
     ) -> None:
-        x_abs = 0 if width == 0 else (x * 4096) // width
-        y_abs = 0 if height == 0 else (y * 4096) // height
-        x_le = int_to_little_endian_list(x_abs)
-        y_le = int_to_little_endian_list(y_abs)
-        data = [0x02, key, *x_le, *y_le, scroll]
-        pkt = CmdPacket(self.addr, CmdEvent.SEND_MS_ABS_DATA, data).encode()
-        self.serial_port.write(bytes(pkt))
-
+        with self._report_lock:
+            if width != self._abs_w or height != self._abs_h:
+                self._abs_w = width
+                self._abs_h = height
+                self._abs_kx = self._abs_scale(width)
+                self._abs_ky = self._abs_scale(height)
+            x_abs = (x * self._abs_kx) >> 32
+            y_abs = (y * self._abs_ky) >> 32
+
+            pkt = self._abs_buf
+            pkt[6] = key
+            pkt[7:9] = int_to_little_endian_bytes(x_abs)
+            pkt[9:11] = int_to_little_endian_bytes(y_abs)
+            pkt[11] = scroll
+            pkt[-1] = checksum(memoryview(pkt)[:-1])
+            self._queue_packet(pkt)
 
 
 if __name__ == '__main__':
@@ -235,6 +459,8 @@ This is a work in progress.
     logging.basicConfig(level=logging.INFO)
     #~ logging.getLogger('root').setLevel(logging.INFO)
     logging.getLogger('rfc2217').setLevel(level)
+    # NOTSET would defer to the root INFO level and hide debug output.
+    logging.getLogger('nanokvm').setLevel(level or logging.DEBUG)
 
 
     # connect to serial port
@@ -262,7 +488,11 @@ This is a work in progress.
 
     print(nano.get_info())
 
-    Gui.launch(nano)
-
-    # Restore previous settings if we can
-    ser.apply_settings(settings)
+    try:
+        Gui.launch(nano)
+    finally:
+        try:
+            nano.close()
+        finally:
+            # Restore previous settings if we can
+            ser.apply_settings(settings)